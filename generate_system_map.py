@@ -10,32 +10,64 @@ Auth:
     or export it in the shell environment.
 
 What it collects (best-effort):
-  - Repo metadata: description, homepage, topics, default_branch, archived, etc.
-  - Language breakdown
+  - Repo metadata: description, homepage, topics (top 20), default_branch, archived, etc.
+  - Language breakdown (top 5 by size)
+  - Repo stats (timestamps, license, issue/star/watcher/fork counts) only when
+    GITHUB_INCLUDE_REPO_STATS=1; otherwise those keys are written as null
   - Contents of common "system mapping" files if present:
       README.md, README.rst, README.txt,
       CODEOWNERS,
       catalog-info.yaml (Backstage),
       openapi.yaml/openapi.yml/swagger.yaml/swagger.yml
+
+Optional dependencies:
+  - pyahocorasick: scans READMEs for auth markers in a single pass
+  - orjson: faster parsing of GraphQL responses and writing of systems_map.json
 """
 
 from __future__ import annotations
 
+import base64
+import http.client
+import itertools
 import json
 import os
+import random
 import re
 import sys
+import threading
 import time
-import urllib.error
+import urllib.parse
 import urllib.request
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple, List
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, Optional, Tuple, List
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 GITHUB_GRAPHQL_API = "https://api.github.com/graphql"
 API_VERSION = "2022-11-28"
 
+# Attempts per GraphQL POST for network errors, 5xx responses and secondary rate limits.
+_MAX_ATTEMPTS = 5
+
+# Serializes rate-limit sleeps so concurrent batches don't all wake up and retry at once.
+_RATE_LIMIT_LOCK = threading.Lock()
+
+# Keep-alive connections, one per (scheme, host) per worker thread; http.client connections aren't thread-safe.
+_CONNECTIONS = threading.local()
+
 
 @dataclass
 class RepoSpec:
@@ -49,75 +81,142 @@ class RepoSpec:
 
 HTTP_METHODS = ("GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD")
 
+_ENV_VAR_RE = re.compile(r"\b[A-Z][A-Z0-9_]*\b")
+# Every env var extract_env_vars keeps contains one of these, so a README without any can skip the regex.
+_ENV_VAR_TELLS = ("_URL", "_TOKEN", "PORT")
+_OPENAPI_PATH_RE = re.compile(r"(?m)^\s{0,4}(?P<path>/[^\s:#]+):\s*$")
+_README_ENDPOINT_RE = re.compile(
+    r"\b(?P<method>" + "|".join(HTTP_METHODS) + r")\b\s+`?(?P<path>/[-A-Za-z0-9_{}:./]+)`?"
+)
+
+# Repo-name substring -> repo kind, checked in order.
+_KIND_REPO_TAGS = (
+    ("test", "tests"),
+    ("infra", "infra"),
+    ("middleware", "library"),
+    ("sdk", "library"),
+    ("service", "service"),
+)
+
+# Primary languages (as canonically named by GitHub) that suggest a deployable service.
+_SERVICE_LANGS = frozenset({"Go", "TypeScript", "JavaScript", "Python"})
+
+# Substrings of the lowercased README -> repo kind, in priority order; "microservice" is already covered by "service".
+_README_KIND_KEYWORDS = (
+    (("service",), "service"),
+    (("library", "middleware"), "library"),
+)
+
+# (marker, lowercased marker) pairs so the README scan never re-lowers a marker.
+_AUTH_MARKERS_LOWER = [
+    (m, m.lower())
+    for m in (
+        "AuthGuard",
+        "RequireRolesGuard",
+        "RequireAllRolesGuard",
+        "@Roles",
+        "@RequireAllRoles",
+        "AuthMiddleware",
+        "RequireRoles(",
+        "RequireAllRoles(",
+    )
+]
+
+_AUTH_AC: Optional[Any] = None
+if ahocorasick is not None:
+    _AUTH_AC = ahocorasick.Automaton()
+    for _marker, _marker_lower in _AUTH_MARKERS_LOWER:
+        _AUTH_AC.add_word(_marker_lower, (_marker, _marker_lower))
+    _AUTH_AC.make_automaton()
+
+
+# Maps A-Z to a-z and leaves every other byte alone, so UTF-8 stays valid after translation.
+_TOLOWER = bytes.maketrans(bytes(range(0x41, 0x5B)), bytes(range(0x61, 0x7B)))
 
-def make_evidence(path: Optional[str], text: Optional[str], needle: str, radius: int = 120) -> Dict[str, Optional[str]]:
-    snippet: Optional[str] = None
-    if isinstance(text, str) and needle:
-        idx = text.lower().find(needle.lower())
-        if idx >= 0:
-            start = max(0, idx - radius)
-            end = min(len(text), idx + len(needle) + radius)
-            snippet = text[start:end].strip()
+
+def ascii_lower(text: str) -> str:
+    """Lowercase A-Z only; unlike str.lower() the result always has the input's length, so offsets line up."""
+    # str.lower() has its own ASCII fast path and can't change an ASCII string's length.
+    if text.isascii():
+        return text.lower()
+    return text.encode("utf-8", "surrogatepass").translate(_TOLOWER).decode("utf-8", "surrogatepass")
+
+
+@dataclass(frozen=True)
+class ScannedText:
+    """A README with its ASCII-lowercased copy and regex matches, computed once and shared by every extractor."""
+
+    text: str
+    lower: str
+    env_hits: Tuple[re.Match, ...]
+    ep_hits: Tuple[re.Match, ...]
+
+    @classmethod
+    def scan(cls, text: str) -> "ScannedText":
+        return cls(
+            text=text,
+            lower=ascii_lower(text),
+            env_hits=tuple(_ENV_VAR_RE.finditer(text)) if any(t in text for t in _ENV_VAR_TELLS) else (),
+            # The endpoint regex needs an upper-case HTTP method, so skip it when none appears at all.
+            ep_hits=tuple(_README_ENDPOINT_RE.finditer(text)) if any(m in text for m in HTTP_METHODS) else (),
+        )
+
+
+def evidence_at(path: Optional[str], text: str, idx: int, length: int, radius: int = 120) -> Dict[str, Optional[str]]:
+    start = max(0, idx - radius)
+    end = min(len(text), idx + length + radius)
     return {
         "path": path,
-        "snippet": snippet,
+        "snippet": text[start:end].strip(),
     }
 
 
-def repo_kind_for(spec: RepoSpec, language: Optional[str], readme_text: Optional[str]) -> str:
+def repo_kind_for(spec: RepoSpec, language: Optional[str], readme: Optional[ScannedText]) -> str:
     repo_name = spec.repo.lower()
-    if "test" in repo_name:
-        return "tests"
-    if "infra" in repo_name:
-        return "infra"
-    if "middleware" in repo_name or "sdk" in repo_name:
-        return "library"
-    if "service" in repo_name:
-        return "service"
-
-    readme = (readme_text or "").lower()
-    if "microservice" in readme or "service" in readme:
-        return "service"
-    if "library" in readme or "middleware" in readme:
-        return "library"
-    if language and language.lower() in {"go", "typescript", "javascript", "python"}:
+    for tag, kind in _KIND_REPO_TAGS:
+        if tag in repo_name:
+            return kind
+
+    if readme is not None:
+        for keywords, kind in _README_KIND_KEYWORDS:
+            if any(keyword in readme.lower for keyword in keywords):
+                return kind
+    if language in _SERVICE_LANGS:
         return "service"
     return "unknown"
 
 
-def extract_env_vars(readme_path: Optional[str], readme_text: Optional[str]) -> List[Dict[str, Any]]:
-    if not isinstance(readme_text, str) or not readme_text.strip():
+def extract_env_vars(readme_path: Optional[str], readme: Optional[ScannedText]) -> List[Dict[str, Any]]:
+    if readme is None:
         return []
 
-    matches = set(re.findall(r"\b[A-Z][A-Z0-9_]*\b", readme_text))
-    keep: List[str] = []
-    for name in matches:
+    # Name -> offset of its first match; evidence is cut from there instead of searching again.
+    first_seen: Dict[str, int] = {}
+    for m in readme.env_hits:
+        name = m.group(0)
+        if name in first_seen:
+            continue
         if (
             name == "PORT"
             or name.endswith("_SERVICE_URL")
             or name.endswith("_URL")
             or name.endswith("_TOKEN")
         ):
-            keep.append(name)
+            first_seen[name] = m.start()
 
     out: List[Dict[str, Any]] = []
-    for name in sorted(set(keep)):
+    for name, start in sorted(first_seen.items()):
         out.append(
             {
                 "name": name,
                 "confidence": "medium",
-                "evidence": make_evidence(readme_path, readme_text, name),
+                "evidence": evidence_at(readme_path, readme.text, start, len(name)),
             }
         )
     return out
 
 
-def infer_depends_on(
-    spec: RepoSpec,
-    env_vars: List[Dict[str, Any]],
-    readme_path: Optional[str],
-    readme_text: Optional[str],
-) -> List[Dict[str, Any]]:
+def infer_depends_on(spec: RepoSpec, env_vars: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     out: List[Dict[str, Any]] = []
     seen = set()
     for env in env_vars:
@@ -134,33 +233,37 @@ def infer_depends_on(
                 "target": target,
                 "type": "http",
                 "confidence": "medium",
-                "evidence": make_evidence(readme_path, readme_text, name),
+                "evidence": env["evidence"],
             }
         )
     return out
 
 
-def extract_auth_signals(readme_path: Optional[str], readme_text: Optional[str]) -> List[Dict[str, Any]]:
-    if not isinstance(readme_text, str) or not readme_text.strip():
+def extract_auth_signals(readme_path: Optional[str], readme: Optional[ScannedText]) -> List[Dict[str, Any]]:
+    if readme is None:
         return []
-    markers = [
-        "AuthGuard",
-        "RequireRolesGuard",
-        "RequireAllRolesGuard",
-        "@Roles",
-        "@RequireAllRoles",
-        "AuthMiddleware",
-        "RequireRoles(",
-        "RequireAllRoles(",
-    ]
+    hay = readme.lower
+
+    # First occurrence of each marker, keyed by marker.
+    found: Dict[str, int] = {}
+    if _AUTH_AC is not None:
+        for end_idx, (marker, marker_lower) in _AUTH_AC.iter(hay):
+            if marker not in found:
+                found[marker] = end_idx - len(marker_lower) + 1
+    else:
+        for marker, marker_lower in _AUTH_MARKERS_LOWER:
+            idx = hay.find(marker_lower)
+            if idx >= 0:
+                found[marker] = idx
+
     out: List[Dict[str, Any]] = []
-    for marker in markers:
-        if marker.lower() in readme_text.lower():
+    for marker, _ in _AUTH_MARKERS_LOWER:
+        if marker in found:
             out.append(
                 {
                     "signal": marker,
                     "confidence": "medium",
-                    "evidence": make_evidence(readme_path, readme_text, marker),
+                    "evidence": evidence_at(readme_path, readme.text, found[marker], len(marker)),
                 }
             )
     return out
@@ -168,48 +271,37 @@ def extract_auth_signals(readme_path: Optional[str], readme_text: Optional[str])
 
 def extract_endpoints(
     readme_path: Optional[str],
-    readme_text: Optional[str],
+    readme: Optional[ScannedText],
     openapi_path: Optional[str],
     openapi_text: Optional[str],
 ) -> List[Dict[str, Any]]:
     endpoints: List[Dict[str, Any]] = []
     seen = set()
 
-    if isinstance(openapi_text, str) and openapi_text.strip():
-        for m in re.finditer(r"(?m)^\s{0,4}(/[^\s:#]+):\s*$", openapi_text):
-            path = m.group(1).strip()
-            if not path.startswith("/"):
-                continue
-            key = ("ANY", path)
-            if key in seen:
-                continue
-            seen.add(key)
-            endpoints.append(
-                {
-                    "method": "ANY",
-                    "path": path,
-                    "source": "openapi",
-                    "confidence": "high",
-                    "evidence": make_evidence(openapi_path, openapi_text, path),
-                }
-            )
-
-    if isinstance(readme_text, str) and readme_text.strip():
-        method_pattern = r"\b(" + "|".join(HTTP_METHODS) + r")\b\s+`?(/[-A-Za-z0-9_{}:./]+)`?"
-        for m in re.finditer(method_pattern, readme_text):
-            method = m.group(1).upper()
-            path = m.group(2)
+    # One loop drives both match streams; OpenAPI paths have no "method" group and are method-agnostic.
+    sources: List[Tuple[Iterable[re.Match], bool, str, str, Optional[str], str]] = []
+    # Every OpenAPI path match starts with "/", so a spec without one has nothing to find.
+    if isinstance(openapi_text, str) and "/" in openapi_text:
+        sources.append((_OPENAPI_PATH_RE.finditer(openapi_text), False, "openapi", "high", openapi_path, openapi_text))
+    if readme is not None:
+        sources.append((readme.ep_hits, True, "readme", "medium", readme_path, readme.text))
+
+    for matches, has_method, source, confidence, doc_path, text in sources:
+        for m in matches:
+            method = m.group("method").upper() if has_method else "ANY"
+            path = m.group("path")
             key = (method, path)
             if key in seen:
                 continue
             seen.add(key)
+            start = m.start("method") if has_method else m.start("path")
             endpoints.append(
                 {
                     "method": method,
                     "path": path,
-                    "source": "readme",
-                    "confidence": "medium",
-                    "evidence": make_evidence(readme_path, readme_text, f"{method} {path}"),
+                    "source": source,
+                    "confidence": confidence,
+                    "evidence": evidence_at(doc_path, text, start, m.end("path") - start),
                 }
             )
 
@@ -273,53 +365,100 @@ def github_session() -> Dict[str, str]:
     return headers
 
 
-def handle_rate_limit(status_code: int, headers: Dict[str, Any]) -> None:
+def handle_rate_limit(status_code: int, headers: http.client.HTTPMessage) -> None:
     # Conservative: if rate-limited, sleep until reset.
     if status_code != 403:
         return
     remaining = headers.get("X-RateLimit-Remaining")
     reset = headers.get("X-RateLimit-Reset")
     if remaining == "0" and reset:
-        try:
-            reset_ts = int(reset)
-            now = int(time.time())
-            sleep_s = max(1, reset_ts - now + 1)
-            print(f"Rate limit hit. Sleeping {sleep_s}s until reset...", file=sys.stderr)
-            time.sleep(sleep_s)
-        except ValueError:
-            pass
+        with _RATE_LIMIT_LOCK:
+            try:
+                reset_ts = int(reset)
+                now = int(time.time())
+                sleep_s = max(1, reset_ts - now + 1)
+                print(f"Rate limit hit. Sleeping {sleep_s}s until reset...", file=sys.stderr)
+                time.sleep(sleep_s)
+            except ValueError:
+                pass
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff (0.5s, 1s, 2s, ... capped at 30s) with jitter so concurrent workers don't retry in lockstep."""
+    return min(30.0, 0.5 * (2**attempt)) * random.uniform(0.5, 1.5)
+
+
+def retry_after_delay(headers: http.client.HTTPMessage, attempt: int) -> float:
+    """Delay requested by a secondary rate limit's Retry-After header, else the regular backoff."""
+    try:
+        return max(1.0, float(headers.get("Retry-After", "")))
+    except ValueError:
+        return backoff_delay(attempt)
+
+
+def json_loads(raw: bytes) -> Any:
+    # Both parsers take the response bytes directly, so large payloads are never copied into an intermediate str.
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def gh_connection(parts: urllib.parse.SplitResult) -> http.client.HTTPConnection:
+    """Return this thread's persistent connection to the URL's host, opening it on first use."""
+    pool: Optional[Dict[Tuple[str, str], http.client.HTTPConnection]] = getattr(_CONNECTIONS, "pool", None)
+    if pool is None:
+        pool = _CONNECTIONS.pool = {}
+    key = (parts.scheme, parts.netloc)
+    conn = pool.get(key)
+    if conn is None:
+        conn = pool[key] = open_connection(parts)
+    return conn
+
+
+def open_connection(parts: urllib.parse.SplitResult) -> http.client.HTTPConnection:
+    """Open a connection to the URL's host, tunnelling through HTTP(S)_PROXY unless NO_PROXY exempts the host."""
+    conn_cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    proxy = urllib.request.getproxies().get(parts.scheme)
+    if not proxy or urllib.request.proxy_bypass(parts.hostname or ""):
+        return conn_cls(parts.netloc, timeout=45)
+
+    # Same proxy settings urlopen's default ProxyHandler honours; the target is reached via CONNECT.
+    proxy_parts = urllib.parse.urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+    proxy_port = proxy_parts.port or (443 if proxy_parts.scheme == "https" else 80)
+    conn = conn_cls(proxy_parts.hostname, proxy_port, timeout=45)
+    tunnel_headers: Dict[str, str] = {}
+    if proxy_parts.username:
+        creds = f"{urllib.parse.unquote(proxy_parts.username)}:{urllib.parse.unquote(proxy_parts.password or '')}"
+        tunnel_headers["Proxy-Authorization"] = "Basic " + base64.b64encode(creds.encode("utf-8")).decode("ascii")
+    conn.set_tunnel(parts.hostname, parts.port, headers=tunnel_headers)
+    return conn
 
 
 def gh_post_json(s: Dict[str, str], url: str, body: Dict[str, Any]) -> Tuple[Optional[Any], Optional[str]]:
     raw_body = json.dumps(body).encode("utf-8")
+    parts = urllib.parse.urlsplit(url)
+    target = parts.path + (f"?{parts.query}" if parts.query else "")
 
-    for attempt in range(3):
-        req = urllib.request.Request(
-            url,
-            data=raw_body,
-            headers={**s, "Content-Type": "application/json"},
-            method="POST",
-        )
-
+    for attempt in range(_MAX_ATTEMPTS):
+        last_attempt = attempt == _MAX_ATTEMPTS - 1
         status_code = 0
-        headers: Dict[str, Any] = {}
+        headers = http.client.HTTPMessage()
         raw: bytes = b""
 
+        conn = gh_connection(parts)
         try:
-            with urllib.request.urlopen(req, timeout=45) as resp:
-                status_code = getattr(resp, "status", 200)
-                headers = dict(resp.headers.items())
-                raw = resp.read()
-        except urllib.error.HTTPError as e:
-            status_code = e.code
-            headers = dict((e.headers or {}).items())
-            try:
-                raw = e.read()
-            except Exception:
-                raw = b""
-        except urllib.error.URLError:
-            if attempt < 2:
-                time.sleep(1 + attempt)
+            conn.request("POST", target, body=raw_body, headers={**s, "Content-Type": "application/json"})
+            resp = conn.getresponse()
+            status_code = resp.status
+            # HTTPMessage lookups are case-insensitive, whatever casing GitHub sends the headers in.
+            headers = resp.headers
+            # Drain the body fully so the connection can be reused for the next request.
+            raw = resp.read()
+        except (http.client.HTTPException, OSError):
+            # Covers stale keep-alive sockets as well as DNS/connect/timeout failures; reconnect on retry.
+            conn.close()
+            if not last_attempt:
+                time.sleep(backoff_delay(attempt))
                 continue
             return None, "network_error"
 
@@ -328,10 +467,16 @@ def gh_post_json(s: Dict[str, str], url: str, body: Dict[str, Any]) -> Tuple[Opt
             if headers.get("X-RateLimit-Remaining") == "0":
                 continue
 
+        # Secondary rate limits come back as 429, or as 403 with a Retry-After header.
+        if (status_code == 429 or (status_code == 403 and headers.get("Retry-After"))) and not last_attempt:
+            time.sleep(retry_after_delay(headers, attempt))
+            continue
+
         if status_code in (200, 201):
             try:
-                return json.loads(raw.decode("utf-8", errors="replace")), None
-            except json.JSONDecodeError:
+                return json_loads(raw), None
+            except ValueError:
+                # JSONDecodeError, or UnicodeDecodeError for a body that isn't valid UTF-8.
                 return None, "invalid_json"
         if status_code == 404:
             return None, "not_found"
@@ -339,8 +484,8 @@ def gh_post_json(s: Dict[str, str], url: str, body: Dict[str, Any]) -> Tuple[Opt
             return None, "unauthorized"
         if status_code == 403:
             return None, "forbidden"
-        if status_code >= 500 and attempt < 2:
-            time.sleep(1 + attempt)
+        if status_code >= 500 and not last_attempt:
+            time.sleep(backoff_delay(attempt))
             continue
         return None, f"http_{status_code}"
 
@@ -351,32 +496,63 @@ def _gql_quote(value: str) -> str:
     return json.dumps(value)
 
 
-def build_repo_query_block(alias: str, spec: RepoSpec) -> str:
-    file_aliases = {
-        "readme_md": "README.md",
-        "readme_rst": "README.rst",
-        "readme_txt": "README.txt",
-        "codeowners_root": "CODEOWNERS",
-        "codeowners_gh": ".github/CODEOWNERS",
-        "catalog_yaml": "catalog-info.yaml",
-        "catalog_yml": "catalog-info.yml",
-        "openapi_yaml": "openapi.yaml",
-        "openapi_yml": "openapi.yml",
-        "swagger_yaml": "swagger.yaml",
-        "swagger_yml": "swagger.yml",
-        "api_openapi_yaml": "api/openapi.yaml",
-        "api_openapi_yml": "api/openapi.yml",
-        "api_swagger_yaml": "api/swagger.yaml",
-        "api_swagger_yml": "api/swagger.yml",
-    }
+# GraphQL alias -> repo path for every file we look for.
+FILE_ALIASES = {
+    "readme_md": "README.md",
+    "readme_rst": "README.rst",
+    "readme_txt": "README.txt",
+    "codeowners_root": "CODEOWNERS",
+    "codeowners_gh": ".github/CODEOWNERS",
+    "catalog_yaml": "catalog-info.yaml",
+    "catalog_yml": "catalog-info.yml",
+    "openapi_yaml": "openapi.yaml",
+    "openapi_yml": "openapi.yml",
+    "swagger_yaml": "swagger.yaml",
+    "swagger_yml": "swagger.yml",
+    "api_openapi_yaml": "api/openapi.yaml",
+    "api_openapi_yml": "api/openapi.yml",
+    "api_swagger_yaml": "api/swagger.yaml",
+    "api_swagger_yml": "api/swagger.yml",
+}
+
+# GraphQL alias -> directory whose entry names are listed up front to decide which FILE_ALIASES to fetch.
+TREE_ALIASES = {
+    "root_tree": "",
+    "github_tree": ".github",
+    "api_tree": "api",
+}
+
+
+# Repo stats that are copied into the output but drive no derived data; only fetched on request.
+REPO_STATS_FIELDS = """
+      createdAt
+      updatedAt
+      pushedAt
+      licenseInfo { spdxId }
+      issues(states: OPEN) { totalCount }
+      stargazerCount
+      watchers { totalCount }
+      forkCount"""
 
-    object_fields = "\n".join(
-        f'{a}: object(expression: {_gql_quote(f"HEAD:{p}")}) {{ ... on Blob {{ text }} }}'
-        for a, p in file_aliases.items()
-    )
 
-    return f'''
-    {alias}: repository(owner: {_gql_quote(spec.owner)}, name: {_gql_quote(spec.repo)}) {{
+def include_repo_stats() -> bool:
+    return os.environ.get("GITHUB_INCLUDE_REPO_STATS", "").strip().lower() in ("1", "true", "yes")
+
+
+# Query text that doesn't depend on the repo is rendered once here; per repo only the
+# alias/owner/name (and the requested blob fields) are substituted in.
+_TREE_FIELDS = "\n".join(
+    f'{a}: object(expression: {_gql_quote(f"HEAD:{d}")}) {{ ... on Tree {{ entries {{ name }} }} }}'
+    for a, d in TREE_ALIASES.items()
+)
+
+_BLOB_FIELDS = {
+    a: f'{a}: object(expression: {_gql_quote(f"HEAD:{p}")}) {{ ... on Blob {{ text }} }}'
+    for a, p in FILE_ALIASES.items()
+}
+
+_REPO_BLOCK_TMPL = """
+    %(alias)s: repository(owner: %(owner)s, name: %(name)s) {
       nameWithOwner
       url
       description
@@ -386,40 +562,113 @@ def build_repo_query_block(alias: str, spec: RepoSpec) -> str:
       isArchived
       isDisabled
       isFork
-      defaultBranchRef {{ name }}
-      createdAt
-      updatedAt
-      pushedAt
-      licenseInfo {{ spdxId }}
-      issues(states: OPEN) {{ totalCount }}
-      stargazerCount
-      watchers {{ totalCount }}
-      forkCount
-      primaryLanguage {{ name }}
-      owner {{ login __typename }}
-      repositoryTopics(first: 100) {{ nodes {{ topic {{ name }} }} }}
-      languages(first: 25, orderBy: {{ field: SIZE, direction: DESC }}) {{
-        edges {{
+      defaultBranchRef { name }%(stats)s
+      primaryLanguage { name }
+      owner { login __typename }
+      repositoryTopics(first: 20) { nodes { topic { name } } }
+      languages(first: 5, orderBy: { field: SIZE, direction: DESC }) {
+        edges {
           size
-          node {{ name }}
-        }}
-      }}
-      {object_fields}
-    }}
-    '''
+          node { name }
+        }
+      }
+      """ + _TREE_FIELDS.replace("%", "%%") + """
+    }
+    """
+
+_REPO_FILES_TMPL = """
+    %(alias)s: repository(owner: %(owner)s, name: %(name)s) {
+      %(fields)s
+    }
+    """
+
+
+def build_repo_query_block(alias: str, spec: RepoSpec, stats_fields: str = "") -> str:
+    return _REPO_BLOCK_TMPL % {
+        "alias": alias,
+        "owner": _gql_quote(spec.owner),
+        "name": _gql_quote(spec.repo),
+        "stats": stats_fields,
+    }
+
+
+def build_repo_files_block(alias: str, spec: RepoSpec, file_aliases: List[str]) -> str:
+    return _REPO_FILES_TMPL % {
+        "alias": alias,
+        "owner": _gql_quote(spec.owner),
+        "name": _gql_quote(spec.repo),
+        "fields": "\n".join(_BLOB_FIELDS[a] for a in file_aliases),
+    }
+
+
+def present_file_aliases(repo_node: Dict[str, Any]) -> List[str]:
+    """FILE_ALIASES whose paths appear in the repo's tree listings."""
+    names_by_dir: Dict[str, set] = {}
+    for tree_alias, directory in TREE_ALIASES.items():
+        entries = ((repo_node.get(tree_alias) or {}).get("entries")) or []
+        names_by_dir[directory] = {e.get("name") for e in entries if isinstance(e, dict)}
+
+    out: List[str] = []
+    for alias, path in FILE_ALIASES.items():
+        directory, _, name = path.rpartition("/")
+        if name in names_by_dir.get(directory, ()):
+            out.append(alias)
+    return out
+
+
+def graphql_errors_by_alias(payload: Dict[str, Any]) -> Dict[str, str]:
+    errors_by_alias: Dict[str, str] = {}
+    for e in payload.get("errors", []) or []:
+        if not isinstance(e, dict):
+            continue
+        path = e.get("path")
+        msg = e.get("message")
+        if isinstance(path, list) and path:
+            alias = str(path[0])
+            errors_by_alias[alias] = str(msg or "graphql_error")
+    return errors_by_alias
+
+
+_MAX_BLOB = 200_000
 
 
-def extract_blob_text(repo_node: Dict[str, Any], alias: str) -> Optional[str]:
+def extract_blob_text(repo_node: Dict[str, Any], alias: str) -> Tuple[Optional[str], bool]:
+    """Blob text for alias, truncated to _MAX_BLOB chars up front; the flag reports truncation."""
     node = repo_node.get(alias)
     if not isinstance(node, dict):
-        return None
+        return None, False
     text = node.get("text")
-    return text if isinstance(text, str) else None
+    if not isinstance(text, str):
+        return None, False
+    if len(text) > _MAX_BLOB:
+        return text[:_MAX_BLOB] + "\n\n[TRUNCATED]\n", True
+    return text, False
+
+
+def file_entry(path: Optional[str], text: Optional[str], truncated: bool) -> Optional[Dict[str, Any]]:
+    if not text:
+        return None
+    entry: Dict[str, Any] = {"path": path, "text": text}
+    if truncated:
+        entry["truncated"] = True
+    return entry
+
+
+def first_present(candidates: List[Tuple[str, Optional[str], bool]]) -> Tuple[Optional[str], Optional[str], bool]:
+    for p, txt, truncated in candidates:
+        if txt is not None:
+            return p, txt, truncated
+    return None, None, False
 
 
 def get_repo_bundle_graphql(s: Dict[str, str], specs: List[RepoSpec]) -> Dict[str, Dict[str, Any]]:
     aliases = {f"r{i}": spec for i, spec in enumerate(specs)}
-    query = "query BatchRepos {\n" + "\n".join(build_repo_query_block(alias, spec) for alias, spec in aliases.items()) + "\n}"
+    stats_fields = REPO_STATS_FIELDS if include_repo_stats() else ""
+    query = (
+        "query BatchRepos {\n"
+        + "\n".join(build_repo_query_block(alias, spec, stats_fields) for alias, spec in aliases.items())
+        + "\n}"
+    )
 
     payload, err = gh_post_json(s, GITHUB_GRAPHQL_API, {"query": query})
     out: Dict[str, Dict[str, Any]] = {}
@@ -429,17 +678,34 @@ def get_repo_bundle_graphql(s: Dict[str, str], specs: List[RepoSpec]) -> Dict[st
             out[spec.full_name] = {"full_name": spec.full_name, "error": err or "unknown"}
         return out
 
-    errors_by_alias: Dict[str, str] = {}
-    for e in payload.get("errors", []) or []:
-        if not isinstance(e, dict):
-            continue
-        path = e.get("path")
-        msg = e.get("message")
-        if isinstance(path, list) and path:
-            alias = str(path[0])
-            errors_by_alias[alias] = str(msg or "graphql_error")
-
+    errors_by_alias = graphql_errors_by_alias(payload)
     data = payload.get("data") or {}
+
+    # Second round-trip fetches only the file blobs the tree listings say exist.
+    wanted: Dict[str, List[str]] = {}
+    for alias in aliases:
+        repo_node = data.get(alias)
+        if alias not in errors_by_alias and isinstance(repo_node, dict):
+            file_aliases = present_file_aliases(repo_node)
+            if file_aliases:
+                wanted[alias] = file_aliases
+
+    if wanted:
+        files_query = (
+            "query BatchRepoFiles {\n"
+            + "\n".join(build_repo_files_block(alias, aliases[alias], fa) for alias, fa in wanted.items())
+            + "\n}"
+        )
+        files_payload, files_err = gh_post_json(s, GITHUB_GRAPHQL_API, {"query": files_query})
+        if files_err or not isinstance(files_payload, dict):
+            for alias in wanted:
+                errors_by_alias[alias] = files_err or "unknown"
+        else:
+            errors_by_alias.update(graphql_errors_by_alias(files_payload))
+            files_data = files_payload.get("data") or {}
+            for alias in wanted:
+                data[alias].update(files_data.get(alias) or {})
+
     for alias, spec in aliases.items():
         if alias in errors_by_alias:
             out[spec.full_name] = {"full_name": spec.full_name, "error": errors_by_alias[alias]}
@@ -450,62 +716,61 @@ def get_repo_bundle_graphql(s: Dict[str, str], specs: List[RepoSpec]) -> Dict[st
             out[spec.full_name] = {"full_name": spec.full_name, "error": "not_found"}
             continue
 
-        topics = [
-            (((n or {}).get("topic") or {}).get("name"))
-            for n in ((repo_node.get("repositoryTopics") or {}).get("nodes") or [])
-            if isinstance(n, dict)
-        ]
-        topics = [t for t in topics if isinstance(t, str)]
+        # Each nested object is looked up once; GraphQL returns null (never another type) for absent values.
+        primary_language = (repo_node.get("primaryLanguage") or {}).get("name")
+        owner = repo_node.get("owner") or {}
+        visibility = repo_node.get("visibility")
+
+        topics: List[str] = []
+        for n in (repo_node.get("repositoryTopics") or {}).get("nodes") or ():
+            topic_name = n and (n.get("topic") or {}).get("name")
+            if topic_name:
+                topics.append(topic_name)
 
         languages: Dict[str, int] = {}
-        for edge in ((repo_node.get("languages") or {}).get("edges") or []):
-            if not isinstance(edge, dict):
+        for edge in (repo_node.get("languages") or {}).get("edges") or ():
+            if not edge:
                 continue
-            lang_name = ((edge.get("node") or {}).get("name"))
+            lang_name = (edge.get("node") or {}).get("name")
             lang_size = edge.get("size")
-            if isinstance(lang_name, str) and isinstance(lang_size, int):
-                languages[lang_name] = int(lang_size)
+            if lang_name and lang_size is not None:
+                languages[lang_name] = lang_size
 
         readme_candidates = [
-            ("README.md", extract_blob_text(repo_node, "readme_md")),
-            ("README.rst", extract_blob_text(repo_node, "readme_rst")),
-            ("README.txt", extract_blob_text(repo_node, "readme_txt")),
+            ("README.md", *extract_blob_text(repo_node, "readme_md")),
+            ("README.rst", *extract_blob_text(repo_node, "readme_rst")),
+            ("README.txt", *extract_blob_text(repo_node, "readme_txt")),
         ]
         codeowners_candidates = [
-            ("CODEOWNERS", extract_blob_text(repo_node, "codeowners_root")),
-            (".github/CODEOWNERS", extract_blob_text(repo_node, "codeowners_gh")),
+            ("CODEOWNERS", *extract_blob_text(repo_node, "codeowners_root")),
+            (".github/CODEOWNERS", *extract_blob_text(repo_node, "codeowners_gh")),
         ]
         catalog_candidates = [
-            ("catalog-info.yaml", extract_blob_text(repo_node, "catalog_yaml")),
-            ("catalog-info.yml", extract_blob_text(repo_node, "catalog_yml")),
+            ("catalog-info.yaml", *extract_blob_text(repo_node, "catalog_yaml")),
+            ("catalog-info.yml", *extract_blob_text(repo_node, "catalog_yml")),
         ]
         openapi_candidates = [
-            ("openapi.yaml", extract_blob_text(repo_node, "openapi_yaml")),
-            ("openapi.yml", extract_blob_text(repo_node, "openapi_yml")),
-            ("swagger.yaml", extract_blob_text(repo_node, "swagger_yaml")),
-            ("swagger.yml", extract_blob_text(repo_node, "swagger_yml")),
-            ("api/openapi.yaml", extract_blob_text(repo_node, "api_openapi_yaml")),
-            ("api/openapi.yml", extract_blob_text(repo_node, "api_openapi_yml")),
-            ("api/swagger.yaml", extract_blob_text(repo_node, "api_swagger_yaml")),
-            ("api/swagger.yml", extract_blob_text(repo_node, "api_swagger_yml")),
+            ("openapi.yaml", *extract_blob_text(repo_node, "openapi_yaml")),
+            ("openapi.yml", *extract_blob_text(repo_node, "openapi_yml")),
+            ("swagger.yaml", *extract_blob_text(repo_node, "swagger_yaml")),
+            ("swagger.yml", *extract_blob_text(repo_node, "swagger_yml")),
+            ("api/openapi.yaml", *extract_blob_text(repo_node, "api_openapi_yaml")),
+            ("api/openapi.yml", *extract_blob_text(repo_node, "api_openapi_yml")),
+            ("api/swagger.yaml", *extract_blob_text(repo_node, "api_swagger_yaml")),
+            ("api/swagger.yml", *extract_blob_text(repo_node, "api_swagger_yml")),
         ]
 
-        def first_present(candidates: List[Tuple[str, Optional[str]]]) -> Tuple[Optional[str], Optional[str]]:
-            for p, txt in candidates:
-                if isinstance(txt, str):
-                    return p, txt
-            return None, None
+        readme_path, readme_text, readme_truncated = first_present(readme_candidates)
+        codeowners_path, codeowners_text, codeowners_truncated = first_present(codeowners_candidates)
+        catalog_path, catalog_text, catalog_truncated = first_present(catalog_candidates)
+        openapi_path, openapi_text, openapi_truncated = first_present(openapi_candidates)
 
-        readme_path, readme_text = first_present(readme_candidates)
-        codeowners_path, codeowners_text = first_present(codeowners_candidates)
-        catalog_path, catalog_text = first_present(catalog_candidates)
-        openapi_path, openapi_text = first_present(openapi_candidates)
-
-        env_vars = extract_env_vars(readme_path, readme_text)
-        depends_on = infer_depends_on(spec, env_vars, readme_path, readme_text)
-        auth_signals = extract_auth_signals(readme_path, readme_text)
-        endpoints = extract_endpoints(readme_path, readme_text, openapi_path, openapi_text)
-        repo_kind = repo_kind_for(spec, ((repo_node.get("primaryLanguage") or {}).get("name")), readme_text)
+        readme = ScannedText.scan(readme_text) if readme_text else None
+        env_vars = extract_env_vars(readme_path, readme)
+        depends_on = infer_depends_on(spec, env_vars)
+        auth_signals = extract_auth_signals(readme_path, readme)
+        endpoints = extract_endpoints(readme_path, readme, openapi_path, openapi_text)
+        repo_kind = repo_kind_for(spec, primary_language, readme)
 
         entry: Dict[str, Any] = {
             "full_name": repo_node.get("nameWithOwner", spec.full_name),
@@ -513,7 +778,7 @@ def get_repo_bundle_graphql(s: Dict[str, str], specs: List[RepoSpec]) -> Dict[st
             "description": repo_node.get("description"),
             "homepage": repo_node.get("homepageUrl"),
             "topics": topics,
-            "visibility": str(repo_node.get("visibility", "")).lower() if repo_node.get("visibility") else None,
+            "visibility": visibility.lower() if visibility else None,
             "private": repo_node.get("isPrivate"),
             "archived": repo_node.get("isArchived"),
             "disabled": repo_node.get("isDisabled"),
@@ -527,17 +792,17 @@ def get_repo_bundle_graphql(s: Dict[str, str], specs: List[RepoSpec]) -> Dict[st
             "stargazers_count": repo_node.get("stargazerCount"),
             "watchers_count": ((repo_node.get("watchers") or {}).get("totalCount")),
             "forks_count": repo_node.get("forkCount"),
-            "language": ((repo_node.get("primaryLanguage") or {}).get("name")),
+            "language": primary_language,
             "owner": {
-                "login": ((repo_node.get("owner") or {}).get("login")),
-                "type": ((repo_node.get("owner") or {}).get("__typename")),
+                "login": owner.get("login"),
+                "type": owner.get("__typename"),
             },
             "languages_bytes": languages,
             "files": {
-                "readme": {"path": readme_path, "text": readme_text} if readme_text else None,
-                "codeowners": {"path": codeowners_path, "text": codeowners_text} if codeowners_text else None,
-                "catalog": {"path": catalog_path, "text": catalog_text} if catalog_text else None,
-                "openapi": {"path": openapi_path, "text": openapi_text} if openapi_text else None,
+                "readme": file_entry(readme_path, readme_text, readme_truncated),
+                "codeowners": file_entry(codeowners_path, codeowners_text, codeowners_truncated),
+                "catalog": file_entry(catalog_path, catalog_text, catalog_truncated),
+                "openapi": file_entry(openapi_path, openapi_text, openapi_truncated),
             },
             "derived": {
                 "repo_kind": repo_kind,
@@ -548,19 +813,50 @@ def get_repo_bundle_graphql(s: Dict[str, str], specs: List[RepoSpec]) -> Dict[st
             },
         }
 
-        for _, v in list(entry["files"].items()):
-            if not v:
-                continue
-            txt = v.get("text") or ""
-            if len(txt) > 200_000:
-                v["text"] = txt[:200_000] + "\n\n[TRUNCATED]\n"
-                v["truncated"] = True
-
         out[spec.full_name] = entry
 
     return out
 
 
+def dump_nested_json(value: Any, level: int) -> bytes:
+    """Serialize value as UTF-8 json.dumps(indent=2) would when nested `level` levels deep."""
+    if orjson is not None:
+        raw = orjson.dumps(value, option=orjson.OPT_INDENT_2)
+    else:
+        raw = json.dumps(value, indent=2, ensure_ascii=False).encode("utf-8")
+    # JSON strings never contain a raw newline, so re-indenting line breaks is safe.
+    return raw.replace(b"\n", b"\n" + b"  " * level)
+
+
+def fetch_batches_in_order(
+    batches: List[List[RepoSpec]],
+    fetch: Callable[[List[RepoSpec]], Dict[str, Dict[str, Any]]],
+    concurrency: int,
+) -> Iterator[Tuple[List[RepoSpec], Dict[str, Dict[str, Any]]]]:
+    """Yield (batch, result) in input order with at most `concurrency` batches in flight or buffered.
+
+    The next batch is only submitted once the caller has consumed the oldest one, so a slow batch
+    (retry backoff, rate-limit sleep) can't let finished results pile up in memory behind it.
+    """
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    todo = iter(batches)
+    pending: Deque[Tuple[List[RepoSpec], Future]] = deque(
+        (chunk, executor.submit(fetch, chunk)) for chunk in itertools.islice(todo, concurrency)
+    )
+    try:
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+            nxt = next(todo, None)
+            if nxt is not None:
+                pending.append((nxt, executor.submit(fetch, nxt)))
+    except BaseException:
+        # Interrupted or failed: drop queued batches and don't block on workers that may be sleeping.
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+
 def main() -> None:
     here = Path(__file__).resolve().parent
     load_dotenv(here / ".env")
@@ -577,43 +873,70 @@ def main() -> None:
             "to use the GitHub GraphQL API and avoid strict unauthenticated rate limits."
         )
 
-    result: Dict[str, Any] = {
+    header: Dict[str, Any] = {
         "schema_version": "1.1",
         "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
         "source": "GitHub GraphQL API",
-        "repos": [],
-        "dependency_edges": [],
     }
+    dependency_edges: List[Dict[str, Any]] = []
 
     batch_size = int(os.environ.get("GITHUB_GRAPHQL_BATCH_SIZE", "20"))
-    for i in range(0, len(specs), batch_size):
-        chunk = specs[i : i + batch_size]
+    concurrency = max(1, int(os.environ.get("GITHUB_GRAPHQL_CONCURRENCY", "4")))
+    batches = [specs[i : i + batch_size] for i in range(0, len(specs), batch_size)]
+
+    def fetch_batch(chunk: List[RepoSpec]) -> Dict[str, Dict[str, Any]]:
         print(
-            "Processing (GraphQL batch): " + ", ".join(s.full_name for s in chunk),
+            "Processing (GraphQL batch): " + ", ".join(spec.full_name for spec in chunk),
             file=sys.stderr,
         )
-        by_repo = get_repo_bundle_graphql(s, chunk)
-        for spec in chunk:
-            entry = by_repo.get(spec.full_name, {"full_name": spec.full_name, "error": "unknown"})
-            result["repos"].append(entry)
-
-            depends_on = (((entry.get("derived") or {}).get("depends_on")) or []) if isinstance(entry, dict) else []
-            for dep in depends_on:
-                target = dep.get("target") if isinstance(dep, dict) else None
-                if not isinstance(target, str) or not target:
-                    continue
-                result["dependency_edges"].append(
-                    {
-                        "from": spec.repo,
-                        "to": target,
-                        "type": dep.get("type", "http") if isinstance(dep, dict) else "http",
-                        "confidence": dep.get("confidence", "medium") if isinstance(dep, dict) else "medium",
-                        "evidence": dep.get("evidence") if isinstance(dep, dict) else None,
-                    }
-                )
+        return get_repo_bundle_graphql(s, chunk)
 
+    # Repos are streamed to a temp file as each batch completes, so at most `concurrency` batches of
+    # README/OpenAPI text are held in memory. The layout matches json.dumps(indent=2) of the whole document.
     out_path = here / "systems_map.json"
-    out_path.write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    try:
+        with tmp_path.open("wb") as fh:
+            fh.write(b"{\n")
+            for key, value in header.items():
+                fh.write(b"  " + dump_nested_json(key, 1) + b": " + dump_nested_json(value, 1) + b",\n")
+            fh.write(b'  "repos": [')
+            first = True
+
+            # Batches are fetched concurrently but yielded in repos.txt order.
+            results = fetch_batches_in_order(batches, fetch_batch, concurrency)
+            try:
+                for chunk, by_repo in results:
+                    for spec in chunk:
+                        entry = by_repo.get(spec.full_name, {"full_name": spec.full_name, "error": "unknown"})
+                        fh.write((b"\n    " if first else b",\n    ") + dump_nested_json(entry, 2))
+                        first = False
+
+                        depends_on = (((entry.get("derived") or {}).get("depends_on")) or []) if isinstance(entry, dict) else []
+                        for dep in depends_on:
+                            target = dep.get("target") if isinstance(dep, dict) else None
+                            if not isinstance(target, str) or not target:
+                                continue
+                            dependency_edges.append(
+                                {
+                                    "from": spec.repo,
+                                    "to": target,
+                                    "type": dep.get("type", "http") if isinstance(dep, dict) else "http",
+                                    "confidence": dep.get("confidence", "medium") if isinstance(dep, dict) else "medium",
+                                    "evidence": dep.get("evidence") if isinstance(dep, dict) else None,
+                                }
+                            )
+            finally:
+                # Runs the generator's cleanup now (cancelling outstanding batches) if the write loop fails.
+                results.close()
+
+            fh.write(b"]," if first else b"\n  ],")
+            fh.write(b'\n  "dependency_edges": ' + dump_nested_json(dependency_edges, 1) + b"\n}")
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    tmp_path.replace(out_path)
     print(f"Wrote {out_path}", file=sys.stderr)
 
 
@@ -621,4 +944,7 @@ if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
-        die("Interrupted", 130)
\ No newline at end of file
+        print("ERROR: Interrupted", file=sys.stderr)
+        sys.stderr.flush()
+        # Skip normal interpreter shutdown: it joins GraphQL worker threads, which may be sleeping until a rate-limit reset.
+        os._exit(130)
\ No newline at end of file